@@ -1,4 +1,5 @@
 import os
+from typing import IO
 
 from openai import AsyncAzureOpenAI
 from openai._legacy_response import HttpxBinaryResponseContent
@@ -25,9 +26,10 @@ class OpenAIClient:
             api_version=os.getenv(azure_api_version_env_name),
         )
 
-    async def upload(self, file_path: str) -> FileObject:
+    async def upload(self, file_name: str, content: bytes | IO[bytes]) -> FileObject:
+        """File objects are streamed by httpx in chunks rather than read into memory. Those reads block the event loop"""
         file = await self._client.files.create(
-            file=open(file_path, "rb"), purpose="batch"
+            file=(file_name, content, "application/jsonl"), purpose="batch"
         )
         self.file_handler.add_file(file.id)
         return file
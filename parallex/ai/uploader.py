@@ -1,66 +1,169 @@
-import base64
+import asyncio
+import binascii
+import hashlib
 import json
+import mmap
 import os
-from typing import Optional
+from collections import deque
+from json.encoder import encode_basestring_ascii
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterable, AsyncIterator, Optional
 from uuid import UUID
 
 from openai.lib._pydantic import to_strict_json_schema
 from pydantic import BaseModel
 
 from parallex.ai.open_ai_client import OpenAIClient
-from parallex.file_management.utils import file_in_temp_dir
 from parallex.models.batch_file import BatchFile
 from parallex.models.image_file import ImageFile
-from parallex.utils.constants import CUSTOM_ID_DELINEATOR
+from parallex.utils.constants import CUSTOM_ID_DELINEATOR, IMAGE_FORMAT
 
 MAX_FILE_SIZE = 180 * 1024 * 1024  # 180 MB in bytes. Limit for Azure is 200MB.
+JSONL_BUFFER_SIZE = 1 << 20  # 1 MB write buffer for the open jsonl file.
+SPOOLED_MAX_SIZE = 16 * 1024 * 1024  # jsonl up to 16 MB is never written to disk.
+WRITE_BUFFER_FLUSH_SIZE = 8 * 1024 * 1024  # Encoded pages are written 8 MB at a time.
+_CUSTOM_ID_PLACEHOLDER = "__parallex_custom_id__"
+_IMAGE_PLACEHOLDER = "__parallex_encoded_image__"
+_PROMPT_PLACEHOLDER = "__parallex_prompt__"
 
 
 async def upload_images_for_processing(
     client: OpenAIClient,
-    image_files: list[ImageFile],
+    image_files: AsyncIterable[ImageFile],
     temp_directory: str,
+    trace_id: UUID,
     prompt_text: str,
     azure_api_deployment_env_name: str,
     model: Optional[type[BaseModel]] = None,
-) -> list[BatchFile]:
-    """Base64 encodes image, converts to expected jsonl format and uploads"""
-    trace_id = image_files[0].trace_id
+    concurrency: Optional[int] = 20,
+) -> AsyncIterator[tuple[BatchFile, dict[int, int]]]:
+    """Base64 encodes image, converts to expected jsonl format and uploads. Yields each BatchFile once uploaded with the repeated pages it skipped, mapped to the page they repeat"""
+    deployment = os.getenv(azure_api_deployment_env_name)
     current_index = 0
-    batch_files = []
-    upload_file_location = file_in_temp_dir(
-        directory=temp_directory, file_name=f"{trace_id}-{current_index}.jsonl"
+    current_bytes = 0
+    duplicate_pages = {}
+    jsonl_buffer = bytearray()
+    jsonl_file = _new_jsonl_file(temp_directory)
+    encoded_images = _encode_images(
+        image_files,
+        prompt_text,
+        deployment,
+        model,
+        concurrency,
     )
 
-    for image_file in image_files:
-        if await _approaching_file_size_limit(upload_file_location):
-            """When approaching upload file limit, upload and start new file"""
-            batch_file = await _create_batch_file(
-                client, trace_id, upload_file_location
+    try:
+        async for page_number, repeated_page_number, jsonl_parts in encoded_images:
+            if repeated_page_number is not None:
+                duplicate_pages[page_number] = repeated_page_number
+                continue
+            if current_bytes > MAX_FILE_SIZE:
+                """When approaching upload file limit, upload and start new file"""
+                await _flush_jsonl_buffer(jsonl_file, jsonl_buffer)
+                batch_file = await _create_batch_file(
+                    client,
+                    trace_id,
+                    jsonl_file,
+                    _jsonl_file_name(current_index, trace_id),
+                )
+                yield batch_file, duplicate_pages
+                duplicate_pages = {}
+                jsonl_file.close()
+                current_index += 1
+                current_bytes = 0
+                jsonl_file = _new_jsonl_file(temp_directory)
+            for jsonl_part in jsonl_parts:
+                jsonl_buffer += jsonl_part
+                current_bytes += len(jsonl_part)
+            if len(jsonl_buffer) >= WRITE_BUFFER_FLUSH_SIZE:
+                await _flush_jsonl_buffer(jsonl_file, jsonl_buffer)
+        await _flush_jsonl_buffer(jsonl_file, jsonl_buffer)
+        batch_file = await _create_batch_file(
+            client, trace_id, jsonl_file, _jsonl_file_name(current_index, trace_id)
+        )
+        yield batch_file, duplicate_pages
+    finally:
+        jsonl_file.close()
+        await encoded_images.aclose()
+
+
+async def _encode_images(
+    image_files: AsyncIterable[ImageFile],
+    prompt_text: str,
+    deployment: str,
+    model: Optional[type[BaseModel]],
+    concurrency: int,
+) -> AsyncIterator[tuple[int, Optional[int], Optional[tuple[bytes, bytes, bytes]]]]:
+    """Encodes images on worker threads, keeping up to `concurrency` in flight and yielding them in page order. Repeated images are yielded with the page they repeat instead of jsonl"""
+    jsonl_start, jsonl_middle, jsonl_suffix = _image_jsonl_format(
+        prompt_text, deployment, model
+    )
+    seen_images = {}
+    encoding = deque()
+    try:
+        async for image_file in image_files:
+            if len(encoding) >= concurrency:
+                yield await _next_encoded_image(encoding, jsonl_suffix)
+            prompt_custom_id = (
+                f"{image_file.trace_id}{CUSTOM_ID_DELINEATOR}{image_file.page_number}.jsonl"
             )
-            batch_files.append(batch_file)
-            upload_file_location = await _increment_batch_file_index(
-                current_index, temp_directory, trace_id
+            jsonl_prefix = jsonl_start + prompt_custom_id.encode() + jsonl_middle
+            encoded_image = asyncio.create_task(
+                asyncio.to_thread(
+                    _encode_image, image_file.path, image_file.page_number, seen_images
+                )
             )
+            encoding.append((image_file.page_number, jsonl_prefix, encoded_image))
+        while encoding:
+            yield await _next_encoded_image(encoding, jsonl_suffix)
+    finally:
+        for _, _, encoded_image in encoding:
+            encoded_image.cancel()
 
-        with open(image_file.path, "rb") as image:
-            base64_encoded_image = base64.b64encode(image.read()).decode("utf-8")
 
-        prompt_custom_id = (
-            f"{image_file.trace_id}{CUSTOM_ID_DELINEATOR}{image_file.page_number}.jsonl"
-        )
-        jsonl = _image_jsonl_format(
-            prompt_custom_id,
-            base64_encoded_image,
-            prompt_text,
-            azure_api_deployment_env_name,
-            model
-        )
-        with open(upload_file_location, "a") as jsonl_file:
-            jsonl_file.write(json.dumps(jsonl) + "\n")
-    batch_file = await _create_batch_file(client, trace_id, upload_file_location)
-    batch_files.append(batch_file)
-    return batch_files
+async def _next_encoded_image(
+    encoding: deque[tuple[int, bytes, asyncio.Task]], jsonl_suffix: bytes
+) -> tuple[int, Optional[int], Optional[tuple[bytes, bytes, bytes]]]:
+    page_number, jsonl_prefix, encoded_image = encoding.popleft()
+    repeated_page_number, encoded_image = await encoded_image
+    if repeated_page_number is not None:
+        return page_number, repeated_page_number, None
+    return page_number, None, (jsonl_prefix, encoded_image, jsonl_suffix)
+
+
+def _encode_image(
+    image_path: str, page_number: int, seen_images: dict[bytes, int]
+) -> tuple[Optional[int], Optional[bytes]]:
+    """Returns the page an identical image was already seen on, or else the image base64 encoded as bytes, mapped rather than read into memory"""
+    with open(image_path, "rb") as image:
+        # mmap cannot map an empty file
+        if os.fstat(image.fileno()).st_size == 0:
+            return _encode_unseen_image(image.read(), page_number, seen_images)
+        with mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as image_bytes:
+            return _encode_unseen_image(image_bytes, page_number, seen_images)
+
+
+def _encode_unseen_image(
+    image_bytes: bytes | mmap.mmap, page_number: int, seen_images: dict[bytes, int]
+) -> tuple[Optional[int], Optional[bytes]]:
+    image_digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    # setdefault is atomic, so exactly one page claims each image across the worker threads
+    first_page_number = seen_images.setdefault(image_digest, page_number)
+    if first_page_number != page_number:
+        return first_page_number, None
+    return None, binascii.b2a_base64(image_bytes, newline=False)
+
+
+async def _flush_jsonl_buffer(
+    jsonl_file: SpooledTemporaryFile, jsonl_buffer: bytearray
+) -> None:
+    """Writes off the event loop, which also covers spilling the jsonl to disk"""
+    await asyncio.to_thread(jsonl_file.write, jsonl_buffer)
+    jsonl_buffer.clear()
+
+
+def _write_parts(jsonl_file: SpooledTemporaryFile, parts: tuple[bytes, ...]) -> int:
+    return sum(jsonl_file.write(part) for part in parts)
 
 
 async def upload_prompts_for_processing(
@@ -71,66 +174,73 @@ async def upload_prompts_for_processing(
     model: Optional[type[BaseModel]] = None,
 ) -> list[BatchFile]:
     """Creates jsonl file and uploads for processing"""
+    jsonl_start, jsonl_middle, jsonl_suffix = _simple_jsonl_format(
+        os.getenv(azure_api_deployment_env_name), model
+    )
     current_index = 0
+    current_bytes = 0
     batch_files = []
+    jsonl_file = _new_jsonl_file(temp_directory)
 
-    upload_file_location = await set_file_location(
-        current_index, temp_directory, trace_id
-    )
-    for index, prompt in enumerate(prompts):
-        if await _approaching_file_size_limit(upload_file_location):
-            """When approaching upload file limit, upload and start new file"""
-            batch_file = await _create_batch_file(
-                client, trace_id, upload_file_location
-            )
-            batch_files.append(batch_file)
-            upload_file_location = await _increment_batch_file_index(
-                current_index, temp_directory, trace_id
-            )
+    try:
+        for index, prompt in enumerate(prompts):
+            if current_bytes > MAX_FILE_SIZE:
+                """When approaching upload file limit, upload and start new file"""
+                batch_file = await _create_batch_file(
+                    client,
+                    trace_id,
+                    jsonl_file,
+                    _jsonl_file_name(current_index, trace_id),
+                )
+                batch_files.append(batch_file)
+                jsonl_file.close()
+                current_index += 1
+                current_bytes = 0
+                jsonl_file = _new_jsonl_file(temp_directory)
 
-        prompt_custom_id = f"{trace_id}{CUSTOM_ID_DELINEATOR}{index}.jsonl"
-        jsonl = _simple_jsonl_format(
-            prompt_custom_id,
-            prompt,
-            azure_api_deployment_env_name,
-            model
+            prompt_custom_id = f"{trace_id}{CUSTOM_ID_DELINEATOR}{index}.jsonl"
+            jsonl_parts = (
+                jsonl_start,
+                prompt_custom_id.encode(),
+                jsonl_middle,
+                encode_basestring_ascii(prompt).encode(),
+                jsonl_suffix,
+            )
+            current_bytes += _write_parts(jsonl_file, jsonl_parts)
+        batch_file = await _create_batch_file(
+            client, trace_id, jsonl_file, _jsonl_file_name(current_index, trace_id)
         )
-        with open(upload_file_location, "a") as jsonl_file:
-            jsonl_file.write(json.dumps(jsonl) + "\n")
-    batch_file = await _create_batch_file(client, trace_id, upload_file_location)
-    batch_files.append(batch_file)
+        batch_files.append(batch_file)
+    finally:
+        jsonl_file.close()
     return batch_files
 
 
-async def set_file_location(
-    current_index: int, temp_directory: str, trace_id: UUID
-) -> str:
-    return file_in_temp_dir(
-        directory=temp_directory, file_name=f"{trace_id}-{current_index}.jsonl"
-    )
-
-
-async def _approaching_file_size_limit(upload_file_location: str) -> bool:
-    return (
-        os.path.exists(upload_file_location)
-        and os.path.getsize(upload_file_location) > MAX_FILE_SIZE
-    )
+def _jsonl_file_name(current_index: int, trace_id: UUID) -> str:
+    return f"{trace_id}-{current_index}.jsonl"
 
 
-async def _increment_batch_file_index(
-    current_index: int, temp_directory: str, trace_id: UUID
-) -> str:
-    current_index += 1
-    upload_file_location = await set_file_location(
-        current_index, temp_directory, trace_id
+def _new_jsonl_file(temp_directory: str) -> SpooledTemporaryFile:
+    """Buffers the jsonl in memory, only spilling to the temp directory for large uploads"""
+    return SpooledTemporaryFile(
+        max_size=SPOOLED_MAX_SIZE,
+        mode="w+b",
+        buffering=JSONL_BUFFER_SIZE,
+        dir=temp_directory,
     )
-    return upload_file_location
 
 
 async def _create_batch_file(
-    client: OpenAIClient, trace_id: UUID, upload_file_location: str
+    client: OpenAIClient,
+    trace_id: UUID,
+    jsonl_file: SpooledTemporaryFile,
+    file_name: str,
 ) -> BatchFile:
-    file_response = await client.upload(upload_file_location)
+    """Sends in memory jsonl as bytes and streams spilled jsonl from disk, where httpx reads it in blocking 64 KB chunks"""
+    in_memory = jsonl_file.tell() <= SPOOLED_MAX_SIZE
+    jsonl_file.seek(0)
+    content = jsonl_file.read() if in_memory else jsonl_file
+    file_response = await client.upload(file_name=file_name, content=content)
     return BatchFile(
         id=file_response.id,
         name=file_response.filename,
@@ -153,39 +263,39 @@ def _response_format(model: type[BaseModel]) -> dict:
 
 
 def _simple_jsonl_format(
-    prompt_custom_id: str,
-    prompt_text: str,
-    azure_api_deployment_env_name: str,
+    deployment: str,
     model: Optional[type[BaseModel]]
-) -> dict:
+) -> tuple[bytes, bytes, bytes]:
+    """Serializes the jsonl line once, split around where the custom_id and JSON encoded prompt belong"""
     payload = {
-        "custom_id": prompt_custom_id,
+        "custom_id": _CUSTOM_ID_PLACEHOLDER,
         "method": "POST",
         "url": "/chat/completions",
         "body": {
-            "model": os.getenv(azure_api_deployment_env_name),
-            "messages": [{"role": "user", "content": prompt_text}],
+            "model": deployment,
+            "messages": [{"role": "user", "content": _PROMPT_PLACEHOLDER}],
             "temperature": 0.0, # TODO make configurable
         },
     }
     if model is not None:
         payload["body"]["response_format"] = _response_format(model)
-    return payload
+    start, _, rest = json.dumps(payload).partition(_CUSTOM_ID_PLACEHOLDER)
+    middle, _, suffix = rest.partition(json.dumps(_PROMPT_PLACEHOLDER))
+    return start.encode(), middle.encode(), (suffix + "\n").encode()
 
 
 def _image_jsonl_format(
-    prompt_custom_id: str,
-    encoded_image: str,
     prompt_text: str,
-    azure_api_deployment_env_name: str,
+    deployment: str,
     model: Optional[type[BaseModel]] = None
-) -> dict:
+) -> tuple[bytes, bytes, bytes]:
+    """Serializes the jsonl line once, split around where the custom_id and base64 encoded image belong"""
     payload = {
-        "custom_id": prompt_custom_id,
+        "custom_id": _CUSTOM_ID_PLACEHOLDER,
         "method": "POST",
         "url": "/chat/completions",
         "body": {
-            "model": os.getenv(azure_api_deployment_env_name),
+            "model": deployment,
             "messages": [
                 {
                     "role": "user",
@@ -194,7 +304,7 @@ def _image_jsonl_format(
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{encoded_image}"
+                                "url": f"data:image/{IMAGE_FORMAT};base64,{_IMAGE_PLACEHOLDER}"
                             },
                         },
                     ],
@@ -206,4 +316,6 @@ def _image_jsonl_format(
     }
     if model is not None:
         payload["body"]["response_format"] = _response_format(model)
-    return payload
+    start, _, rest = json.dumps(payload).partition(_CUSTOM_ID_PLACEHOLDER)
+    middle, _, suffix = rest.partition(_IMAGE_PLACEHOLDER)
+    return start.encode(), middle.encode(), (suffix + "\n").encode()
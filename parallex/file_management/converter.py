@@ -1,37 +1,91 @@
 import asyncio
+import math
+from collections import deque
+from typing import AsyncIterator
 
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 
 from parallex.models.image_file import ImageFile
 from parallex.models.raw_file import RawFile
+from parallex.utils.constants import IMAGE_FORMAT
 from parallex.utils.logger import logger
 
+CONVERSION_PROCESSES = 4  # Ranges rasterized at once, each by one pdftocairo process.
+MIN_PAGES_PER_CONVERSION = 8
+MAX_CONVERSIONS = 32  # Bounds pdftocairo and pdfinfo runs for long PDFs.
+
+
+async def pdf_page_count(raw_file: RawFile) -> int:
+    """Reads the number of pages in the PDF without rasterizing it"""
+    pdf_info = await asyncio.to_thread(pdfinfo_from_path, raw_file.path)
+    return pdf_info["Pages"]
+
 
 async def convert_pdf_to_images(
-    raw_file: RawFile, temp_directory: str
+    raw_file: RawFile, temp_directory: str, total_pages: int
+) -> AsyncIterator[ImageFile]:
+    """Converts a PDF file to a series of images in the temp_directory. Yields ImageFile objects in page order as each range of pages is rasterized."""
+    pages_per_conversion = max(
+        MIN_PAGES_PER_CONVERSION, math.ceil(total_pages / MAX_CONVERSIONS)
+    )
+    conversions = deque()
+    try:
+        for first_page in range(1, total_pages + 1, pages_per_conversion):
+            if len(conversions) >= CONVERSION_PROCESSES:
+                for image_file in await _next_converted_range(raw_file, conversions):
+                    yield image_file
+            last_page = min(first_page + pages_per_conversion - 1, total_pages)
+            conversions.append(
+                (
+                    first_page,
+                    _start_conversion(raw_file, temp_directory, first_page, last_page),
+                )
+            )
+        while conversions:
+            for image_file in await _next_converted_range(raw_file, conversions):
+                yield image_file
+    except Exception as err:
+        logger.error(f"Error converting PDF to images: {err}")
+        raise err
+    finally:
+        # pdftocairo must not be writing while the temp directory is removed
+        await asyncio.gather(
+            *(conversion for _, conversion in conversions), return_exceptions=True
+        )
+
+
+async def _next_converted_range(
+    raw_file: RawFile, conversions: deque[tuple[int, asyncio.Task]]
 ) -> list[ImageFile]:
-    """Converts a PDF file to a series of images in the temp_directory. Returns a list ImageFile objects."""
+    """Waits on the oldest conversion, which stays in the window until it has finished"""
+    first_page, conversion = conversions[0]
+    image_paths = await asyncio.shield(conversion)
+    conversions.popleft()
+    return [
+        ImageFile(
+            path=path,
+            trace_id=raw_file.trace_id,
+            given_file_name=raw_file.given_name,
+            page_number=(first_page + i),
+        )
+        for i, path in enumerate(image_paths)
+    ]
+
+
+def _start_conversion(
+    raw_file: RawFile, temp_directory: str, first_page: int, last_page: int
+) -> asyncio.Task:
     options = {
         "pdf_path": raw_file.path,
         "output_folder": temp_directory,
         "dpi": 300,
-        "fmt": "png",
+        "fmt": IMAGE_FORMAT,
+        "jpegopt": {"quality": 85, "optimize": True},
         "size": (None, 1056),
-        "thread_count": 4,
+        "thread_count": 1,
         "use_pdftocairo": True,
         "paths_only": True,
+        "first_page": first_page,
+        "last_page": last_page,
     }
-
-    try:
-        image_paths = await asyncio.to_thread(convert_from_path, **options)
-        return [
-            ImageFile(
-                path=path,
-                trace_id=raw_file.trace_id,
-                given_file_name=raw_file.given_name,
-                page_number=(i + 1),
-            )
-            for i, path in enumerate(image_paths)
-        ]
-    except Exception as err:
-        logger.error(f"Error converting PDF to images: {err}")
+    return asyncio.create_task(asyncio.to_thread(convert_from_path, **options))
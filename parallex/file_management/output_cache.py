@@ -0,0 +1,94 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import tempfile
+from typing import Optional
+
+from pydantic import BaseModel
+
+from parallex.models.parallex_callable_output import ParallexCallableOutput
+from parallex.models.raw_file import RawFile
+from parallex.utils.logger import logger
+
+
+def output_cache_key(
+    raw_file: RawFile,
+    prompt_text: str,
+    deployment: str,
+    model: Optional[type[BaseModel]] = None,
+) -> str:
+    """Builds a key from the PDF contents, prompt and model so outputs are only reused for identical requests"""
+    with open(raw_file.path, "rb") as pdf:
+        pdf_digest = hashlib.file_digest(pdf, "sha256").hexdigest()
+    prompt_digest = hashlib.sha256(prompt_text.encode()).hexdigest()
+    key = f"{pdf_digest}-{prompt_digest}-{deployment}"
+    if model is not None:
+        key += json.dumps(model.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+async def read_cached_output(
+    cache_dir: str, key: str, model: Optional[type[BaseModel]] = None
+) -> Optional[ParallexCallableOutput]:
+    """Returns the cached output for the key or None when it has not been cached"""
+    path = _cache_file_path(cache_dir, key)
+    try:
+        return await asyncio.to_thread(_load_cached_output, path, model)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        # A corrupt or outdated cache file is treated as a miss
+        logger.warning(f"Ignoring unreadable cached output {path}: {err}")
+        return None
+
+
+async def write_cached_output(
+    cache_dir: str, key: str, output: ParallexCallableOutput
+) -> None:
+    """Failures are only logged since the output has already been produced"""
+    try:
+        await asyncio.to_thread(_write_cache_file, cache_dir, key, output)
+    except Exception as err:
+        logger.warning(f"Failed to write cached output to {cache_dir}: {err}")
+
+
+def _load_cached_output(
+    path: str, model: Optional[type[BaseModel]]
+) -> ParallexCallableOutput:
+    output = json.loads(_read_cache_file(path, os.stat(path).st_mtime_ns))
+    if model is not None:
+        for page in output["pages"]:
+            page["output_content"] = model.model_validate(page["output_content"])
+    return ParallexCallableOutput.model_validate(output)
+
+
+def _write_cache_file(cache_dir: str, key: str, output: ParallexCallableOutput) -> None:
+    """Writes to a temp file and renames it so readers never see a partial file"""
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir, suffix=".tmp", delete=False
+        ) as cache_file:
+            temp_path = cache_file.name
+            cache_file.write(output.model_dump_json(serialize_as_any=True))
+        os.replace(temp_path, _cache_file_path(cache_dir, key))
+    except Exception:
+        if temp_path is not None:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+        raise
+
+
+def _cache_file_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+@functools.lru_cache(maxsize=32)
+def _read_cache_file(path: str, mtime_ns: int) -> str:
+    """Keyed on modification time so a replaced file is read again. Misses raise FileNotFoundError, which lru_cache does not cache"""
+    with open(path) as cache_file:
+        return cache_file.read()
@@ -1,4 +1,5 @@
 import asyncio
+import os
 import tempfile
 import uuid
 from typing import Callable, Optional
@@ -13,10 +14,16 @@ from parallex.ai.uploader import (
     upload_images_for_processing,
     upload_prompts_for_processing,
 )
-from parallex.file_management.converter import convert_pdf_to_images
+from parallex.file_management.converter import convert_pdf_to_images, pdf_page_count
 from parallex.file_management.file_finder import add_file_to_temp_directory
+from parallex.file_management.output_cache import (
+    output_cache_key,
+    read_cached_output,
+    write_cached_output,
+)
 from parallex.file_management.remote_file_handler import RemoteFileHandler
 from parallex.models.batch_file import BatchFile
+from parallex.models.page_response import PageResponse
 from parallex.models.parallex_callable_output import ParallexCallableOutput
 from parallex.models.parallex_prompts_callable_output import (
     ParallexPromptsCallableOutput,
@@ -25,6 +32,10 @@ from parallex.models.upload_batch import UploadBatch
 from parallex.utils.constants import DEFAULT_PROMPT
 from parallex.utils.logger import logger, setup_logger
 
+# Creating a batch returns almost immediately while waiting on one takes minutes,
+# so creation gets a small budget of its own and waiting uses the full concurrency.
+MAX_CONCURRENT_BATCH_CREATES = 5
+
 
 # TODO pdf_source_url: str change to be URL or path
 async def parallex(
@@ -39,6 +50,7 @@ async def parallex(
     azure_api_key_env_name: Optional[str] = "AZURE_API_KEY",
     azure_api_version_env_name: Optional[str] = "AZURE_API_VERSION",
     azure_api_deployment_env_name: Optional[str] = "AZURE_API_DEPLOYMENT",
+    cache_dir: Optional[str] = None,
 ) -> ParallexCallableOutput:
     setup_logger(log_level)
     remote_file_handler = RemoteFileHandler()
@@ -56,13 +68,16 @@ async def parallex(
             concurrency=concurrency,
             prompt_text=prompt_text,
             azure_api_deployment_env_name=azure_api_deployment_env_name,
-            model=response_model
+            model=response_model,
+            cache_dir=cache_dir,
         )
     except Exception as e:
         logger.error(f"Error occurred: {e}")
         raise e
     finally:
-        await _delete_associated_files(open_ai_client, remote_file_handler)
+        await _delete_associated_files(
+            open_ai_client, remote_file_handler, concurrency
+        )
 
 
 async def parallex_simple_prompts(
@@ -97,7 +112,9 @@ async def parallex_simple_prompts(
         logger.error(f"Error occurred: {e}")
         raise e
     finally:
-        await _delete_associated_files(open_ai_client, remote_file_handler)
+        await _delete_associated_files(
+            open_ai_client, remote_file_handler, concurrency
+        )
 
 
 async def _prompts_execute(
@@ -118,7 +135,9 @@ async def _prompts_execute(
             azure_api_deployment_env_name=azure_api_deployment_env_name,
             model=model,
         )
-        start_batch_semaphore = asyncio.Semaphore(concurrency)
+        start_batch_semaphore = asyncio.Semaphore(
+            min(concurrency, MAX_CONCURRENT_BATCH_CREATES)
+        )
         start_batch_tasks = []
         for file in batch_files:
             batch_task = asyncio.create_task(
@@ -165,52 +184,97 @@ async def _execute(
     concurrency: Optional[int] = 20,
     prompt_text: Optional[str] = DEFAULT_PROMPT,
     model: Optional[type[BaseModel]] = None,
+    cache_dir: Optional[str] = None,
 ) -> ParallexCallableOutput:
     with tempfile.TemporaryDirectory() as temp_directory:
         raw_file = await add_file_to_temp_directory(
             pdf_source_url=pdf_source_url, temp_directory=temp_directory
         )
         trace_id = raw_file.trace_id
-        image_files = await convert_pdf_to_images(
-            raw_file=raw_file, temp_directory=temp_directory
+        if cache_dir is not None:
+            cache_key = await asyncio.to_thread(
+                output_cache_key,
+                raw_file=raw_file,
+                prompt_text=prompt_text,
+                deployment=os.getenv(azure_api_deployment_env_name),
+                model=model,
+            )
+            cached_output = await read_cached_output(cache_dir, cache_key, model)
+            if cached_output is not None:
+                logger.info(f"using cached output - {cache_key} - {trace_id}")
+                # The cache is keyed on PDF contents, so this call's details replace the cached run's
+                cached_output = cached_output.model_copy(
+                    update={
+                        "trace_id": trace_id,
+                        "pdf_source_url": raw_file.pdf_source_url,
+                        "file_name": raw_file.given_name,
+                    }
+                )
+                if post_process_callable is not None:
+                    post_process_callable(output=cached_output)
+                return cached_output
+        total_pages = await pdf_page_count(raw_file)
+        image_files = convert_pdf_to_images(
+            raw_file=raw_file, temp_directory=temp_directory, total_pages=total_pages
         )
 
-        batch_files = await upload_images_for_processing(
+        # Pages flow from rasterizing to upload to batches as they are ready
+        batch_files = upload_images_for_processing(
             client=open_ai_client,
             image_files=image_files,
             temp_directory=temp_directory,
+            trace_id=trace_id,
             prompt_text=prompt_text,
             model=model,
-            azure_api_deployment_env_name=azure_api_deployment_env_name
+            azure_api_deployment_env_name=azure_api_deployment_env_name,
+            concurrency=concurrency,
         )
-        start_batch_semaphore = asyncio.Semaphore(concurrency)
-        start_batch_tasks = []
-        for file in batch_files:
-            batch_task = asyncio.create_task(
-                _create_batch_jobs(
-                    batch_file=file,
-                    client=open_ai_client,
-                    trace_id=trace_id,
-                    semaphore=start_batch_semaphore,
-                )
-            )
-            start_batch_tasks.append(batch_task)
-        batch_jobs = await asyncio.gather(*start_batch_tasks)
+        start_batch_semaphore = asyncio.Semaphore(
+            min(concurrency, MAX_CONCURRENT_BATCH_CREATES)
+        )
+        batch_file_queue = asyncio.Queue(maxsize=concurrency * 2)
+        duplicate_pages = {}
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                workers = [
+                    task_group.create_task(
+                        _create_batches_and_wait_for_pages(
+                            batch_file_queue=batch_file_queue,
+                            client=open_ai_client,
+                            trace_id=trace_id,
+                            start_batch_semaphore=start_batch_semaphore,
+                            model=model,
+                        )
+                    )
+                    for _ in range(concurrency)
+                ]
+                async for file, skipped_pages in batch_files:
+                    duplicate_pages.update(skipped_pages)
+                    await batch_file_queue.put(file)
+                for _ in workers:
+                    await batch_file_queue.put(None)
+        except ExceptionGroup as error_group:
+            # Raise the first failure itself so callers see the same exceptions as without the worker pool
+            raise error_group.exceptions[0]
+        finally:
+            # Close the pipeline when stopping early so running conversions finish before the temp directory is removed
+            await batch_files.aclose()
+            await image_files.aclose()
+        page_groups = [worker.result() for worker in workers]
 
-        pages_tasks = []
-        process_semaphore = asyncio.Semaphore(concurrency)
-        for batch in batch_jobs:
-            page_task = asyncio.create_task(
-                _wait_and_create_pages(
-                    batch=batch, client=open_ai_client, semaphore=process_semaphore, model=model
+        # Page numbers are dense, so each page is placed at its index instead of sorting
+        sorted_pages = [None] * total_pages
+        for batch_pages in page_groups:
+            for page in batch_pages:
+                sorted_pages[page.page_number - 1] = page
+        for page_number, original_page_number in duplicate_pages.items():
+            original_page = sorted_pages[original_page_number - 1]
+            if original_page is not None:
+                sorted_pages[page_number - 1] = original_page.model_copy(
+                    update={"page_number": page_number}
                 )
-            )
-            pages_tasks.append(page_task)
-        page_groups = await asyncio.gather(*pages_tasks)
-
-        pages = [page for batch_pages in page_groups for page in batch_pages]
-        logger.info(f"pages done. total pages- {len(pages)} - {trace_id}")
-        sorted_pages = sorted(pages, key=lambda x: x.page_number)
+        sorted_pages = [page for page in sorted_pages if page is not None]
+        logger.info(f"pages done. total pages- {len(sorted_pages)} - {trace_id}")
 
         # TODO add combined version of MD to output / save to file system
         callable_output = ParallexCallableOutput(
@@ -219,22 +283,50 @@ async def _execute(
             trace_id=trace_id,
             pages=sorted_pages,
         )
+        if cache_dir is not None:
+            if len(sorted_pages) == total_pages:
+                await write_cached_output(cache_dir, cache_key, callable_output)
+            else:
+                logger.warning(
+                    f"not caching incomplete output, {len(sorted_pages)} of {total_pages} pages - {trace_id}"
+                )
         if post_process_callable is not None:
             post_process_callable(output=callable_output)
         return callable_output
 
 
+async def _create_batches_and_wait_for_pages(
+    batch_file_queue: asyncio.Queue,
+    client: OpenAIClient,
+    trace_id: UUID,
+    start_batch_semaphore: asyncio.Semaphore,
+    model: Optional[type[BaseModel]] = None,
+) -> list[PageResponse]:
+    """Worker that creates and waits on batches from the queue until it receives None"""
+    page_responses = []
+    while (batch_file := await batch_file_queue.get()) is not None:
+        batch = await _create_batch_jobs(
+            batch_file=batch_file,
+            client=client,
+            trace_id=trace_id,
+            semaphore=start_batch_semaphore,
+        )
+        page_responses.extend(
+            await _wait_and_create_pages(batch=batch, client=client, model=model)
+        )
+    return page_responses
+
+
 async def _wait_and_create_pages(
-    batch: UploadBatch, client: OpenAIClient, semaphore: asyncio.Semaphore, model: Optional[type[BaseModel]] = None
+    batch: UploadBatch, client: OpenAIClient, model: Optional[type[BaseModel]] = None
 ):
-    async with semaphore:
-        logger.info(f"waiting for batch to complete - {batch.id} - {batch.trace_id}")
-        output_file_id = await wait_for_batch_completion(client=client, batch=batch)
-        logger.info(f"batch completed - {batch.id} - {batch.trace_id}")
-        page_responses = await process_images_output(
-            client=client, output_file_id=output_file_id, model=model,
-        )
-        return page_responses
+    logger.info(f"waiting for batch to complete - {batch.id} - {batch.trace_id}")
+    output_file_id = await wait_for_batch_completion(client=client, batch=batch)
+    logger.info(f"batch completed - {batch.id} - {batch.trace_id}")
+    page_responses = await process_images_output(
+        client=client, output_file_id=output_file_id, model=model,
+    )
+    return page_responses
 
 
 async def _wait_and_create_prompt_responses(
@@ -263,7 +355,15 @@ async def _create_batch_jobs(
         return upload_batch
 
 
-async def _delete_associated_files(open_ai_client, remote_file_handler):
-    for file in remote_file_handler.created_files:
-        logger.info(f"deleting - {file}")
-        await open_ai_client.delete_file(file)
+async def _delete_associated_files(open_ai_client, remote_file_handler, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _delete_file(file):
+        async with semaphore:
+            logger.info(f"deleting - {file}")
+            await open_ai_client.delete_file(file)
+
+    await asyncio.gather(
+        *(_delete_file(file) for file in remote_file_handler.created_files),
+        return_exceptions=True,
+    )
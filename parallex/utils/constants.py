@@ -7,3 +7,6 @@ DEFAULT_PROMPT = """
     """
 
 CUSTOM_ID_DELINEATOR = "--parallex--"
+
+# JPEG is several times smaller than PNG for rasterized pages, cutting base64 work, upload size and input tokens
+IMAGE_FORMAT = "jpeg"
@@ -0,0 +1,106 @@
+import unittest
+import uuid
+from unittest import mock
+
+from parallex import parallex
+from parallex.models.batch_file import BatchFile
+from parallex.models.page_response import PageResponse
+from parallex.models.raw_file import RawFile
+from parallex.models.upload_batch import UploadBatch
+
+TRACE_ID = uuid.uuid4()
+
+# Pages 3 and 5 repeat pages 1 and 2, so only pages 1, 2 and 4 are uploaded
+UPLOADED_PAGES = {"file-1": [1, 2], "file-2": [4]}
+SKIPPED_PAGES = {"file-1": {3: 1}, "file-2": {5: 2}}
+
+
+async def _add_file_to_temp_directory(pdf_source_url, temp_directory):
+    return RawFile(
+        name="test.pdf",
+        path=f"{temp_directory}/test.pdf",
+        content_type="application/pdf",
+        given_name="test.pdf",
+        pdf_source_url=pdf_source_url,
+        trace_id=TRACE_ID,
+    )
+
+
+async def _pdf_page_count(raw_file):
+    return 5
+
+
+async def _convert_pdf_to_images(**kwargs):
+    return
+    yield
+
+
+async def _upload_images_for_processing(**kwargs):
+    async for _ in kwargs["image_files"]:
+        pass
+    for file_id, skipped_pages in SKIPPED_PAGES.items():
+        batch_file = BatchFile(
+            id=file_id,
+            name=f"{file_id}.jsonl",
+            purpose="batch",
+            status="processed",
+            trace_id=TRACE_ID,
+        )
+        yield batch_file, skipped_pages
+
+
+async def _create_batch(client, file_id, trace_id):
+    return UploadBatch(
+        id=f"batch-{file_id}",
+        completion_window="24h",
+        created_at=0,
+        endpoint="/chat/completions",
+        input_file_id=file_id,
+        status="validating",
+        trace_id=trace_id,
+    )
+
+
+async def _wait_for_batch_completion(client, batch):
+    return batch.input_file_id
+
+
+async def _process_images_output(client, output_file_id, model=None):
+    return [
+        PageResponse(output_content=f"page {page_number}", page_number=page_number)
+        for page_number in UPLOADED_PAGES[output_file_id]
+    ]
+
+
+@mock.patch.multiple(
+    parallex,
+    add_file_to_temp_directory=_add_file_to_temp_directory,
+    pdf_page_count=_pdf_page_count,
+    convert_pdf_to_images=_convert_pdf_to_images,
+    upload_images_for_processing=_upload_images_for_processing,
+    create_batch=_create_batch,
+    wait_for_batch_completion=_wait_for_batch_completion,
+    process_images_output=_process_images_output,
+)
+class TestExecute(unittest.IsolatedAsyncioTestCase):
+    async def test_repeated_pages_copy_their_original_response(self):
+        output = await parallex._execute(
+            open_ai_client=mock.Mock(),
+            pdf_source_url="https://example.com/test.pdf",
+            azure_api_deployment_env_name="TEST_DEPLOYMENT",
+            concurrency=2,
+        )
+        self.assertEqual(
+            [(page.page_number, page.output_content) for page in output.pages],
+            [
+                (1, "page 1"),
+                (2, "page 2"),
+                (3, "page 1"),
+                (4, "page 4"),
+                (5, "page 2"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import base64
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from types import SimpleNamespace
+from unittest import mock
+
+from pydantic import BaseModel
+
+from parallex.ai.uploader import (
+    _response_format,
+    upload_images_for_processing,
+    upload_prompts_for_processing,
+)
+from parallex.models.image_file import ImageFile
+from parallex.utils.constants import CUSTOM_ID_DELINEATOR, IMAGE_FORMAT
+
+DEPLOYMENT = "test-deployment"
+PROMPT_TEXT = 'Convert "this" page — café, 日本語\\ and\nnewlines'
+
+
+class PageSummary(BaseModel):
+    title: str
+    body: str
+
+
+class FakeClient:
+    def __init__(self):
+        self.uploads = []
+
+    async def upload(self, file_name, content):
+        data = content if isinstance(content, bytes) else content.read()
+        self.uploads.append(data)
+        return SimpleNamespace(
+            id=f"file-{len(self.uploads)}",
+            filename=file_name,
+            purpose="batch",
+            status="processed",
+        )
+
+
+def _expected_image_line(custom_id, image, prompt_text, model=None):
+    """The line json.dumps produced for each image before the template was split"""
+    payload = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/chat/completions",
+        "body": {
+            "model": DEPLOYMENT,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt_text},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:image/{IMAGE_FORMAT};base64,{base64.b64encode(image).decode()}"
+                            },
+                        },
+                    ],
+                }
+            ],
+            "max_tokens": 2000,
+            "response_format": {"type": "json_object"},
+        },
+    }
+    if model is not None:
+        payload["body"]["response_format"] = _response_format(model)
+    return (json.dumps(payload) + "\n").encode()
+
+
+def _expected_prompt_line(custom_id, prompt, model=None):
+    """The line json.dumps produced for each prompt before the template was split"""
+    payload = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/chat/completions",
+        "body": {
+            "model": DEPLOYMENT,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.0,
+        },
+    }
+    if model is not None:
+        payload["body"]["response_format"] = _response_format(model)
+    return (json.dumps(payload) + "\n").encode()
+
+
+@mock.patch.dict(os.environ, {"TEST_DEPLOYMENT": DEPLOYMENT})
+class TestImageJsonl(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.temp_directory = tempfile.TemporaryDirectory()
+        self.trace_id = uuid.uuid4()
+        self.images = [os.urandom(1000 + page) for page in range(3)] + [b""]
+
+    async def asyncTearDown(self):
+        self.temp_directory.cleanup()
+
+    async def _image_files(self):
+        for page_number, image in enumerate(self.images, start=1):
+            path = os.path.join(self.temp_directory.name, f"{page_number}.jpg")
+            with open(path, "wb") as image_file:
+                image_file.write(image)
+            yield ImageFile(
+                path=path,
+                page_number=page_number,
+                given_file_name="test.pdf",
+                trace_id=self.trace_id,
+            )
+
+    async def _upload(self, prompt_text, model=None):
+        client = FakeClient()
+        batches = [
+            batch
+            async for batch in upload_images_for_processing(
+                client=client,
+                image_files=self._image_files(),
+                temp_directory=self.temp_directory.name,
+                trace_id=self.trace_id,
+                prompt_text=prompt_text,
+                azure_api_deployment_env_name="TEST_DEPLOYMENT",
+                model=model,
+                concurrency=2,
+            )
+        ]
+        self.assertEqual(len(batches), 1)
+        return client.uploads[0]
+
+    def _expected(self, prompt_text, model=None):
+        return b"".join(
+            _expected_image_line(
+                f"{self.trace_id}{CUSTOM_ID_DELINEATOR}{page_number}.jsonl",
+                image,
+                prompt_text,
+                model,
+            )
+            for page_number, image in enumerate(self.images, start=1)
+        )
+
+    async def test_matches_json_dumps(self):
+        uploaded = await self._upload(PROMPT_TEXT)
+        self.assertEqual(uploaded, self._expected(PROMPT_TEXT))
+
+    async def test_matches_json_dumps_with_response_model(self):
+        uploaded = await self._upload(PROMPT_TEXT, PageSummary)
+        self.assertEqual(uploaded, self._expected(PROMPT_TEXT, PageSummary))
+
+
+@mock.patch.dict(os.environ, {"TEST_DEPLOYMENT": DEPLOYMENT})
+class TestPromptJsonl(unittest.IsolatedAsyncioTestCase):
+    prompts = [PROMPT_TEXT, "", "plain", '{"json": "looking"}', "emoji 🙂 \u2028"]
+
+    async def _upload(self, model=None):
+        client = FakeClient()
+        trace_id = uuid.uuid4()
+        with tempfile.TemporaryDirectory() as temp_directory:
+            batch_files = await upload_prompts_for_processing(
+                client=client,
+                prompts=self.prompts,
+                temp_directory=temp_directory,
+                trace_id=trace_id,
+                azure_api_deployment_env_name="TEST_DEPLOYMENT",
+                model=model,
+            )
+        self.assertEqual(len(batch_files), 1)
+        expected = b"".join(
+            _expected_prompt_line(
+                f"{trace_id}{CUSTOM_ID_DELINEATOR}{index}.jsonl", prompt, model
+            )
+            for index, prompt in enumerate(self.prompts)
+        )
+        self.assertEqual(client.uploads[0], expected)
+
+    async def test_matches_json_dumps(self):
+        await self._upload()
+
+    async def test_matches_json_dumps_with_response_model(self):
+        await self._upload(PageSummary)
+
+
+if __name__ == "__main__":
+    unittest.main()